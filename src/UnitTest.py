@@ -1,13 +1,21 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from aggregator import aggregate_weather_data
+from aggregator import aggregate_weather_data, normalize_weather_data
 from fetch_weather import (
     fetch_weather_openweathermap,
     fetch_weather_visualcrossing,
     fetch_weather_weatherapi,
 )
-from preferences import load_preferences, save_preferences
+from preferences import load_preferences, save_preferences, PreferencesStore
 from api_keys import load_api_keys
+from batch import aggregate_weather_batch
+import fetch_weather
+from rolling_stats import RollingStats
+from scheduler import FetchScheduler
+import cassette
+import tracing
+from adaptive import AdaptiveFanout
+from cache import CacheBackend, MemoryCache, RedisCache, CacheError, cached_aggregate_weather_data, cached_aggregate_many
 
 class TestWeatherAggregator(unittest.TestCase):
     def setUp(self):
@@ -538,5 +546,716 @@ class TestStressTesting(unittest.TestCase):
             self.assertIsNotNone(result["avg_low_temp"])
             self.assertIsNotNone(result["avg_humidity"])
 
+def batch_city(city, sources):
+    """Stands in for aggregate_weather_data in the batch workers, it has to be picklable for spawn."""
+    return {"city": city, "sources": sorted(sources)}
+
+def batch_throttled_city(city, sources):
+    fetch_weather._throttle("OpenWeatherMap")
+    return {"city": city}
+
+def batch_timed_city(city, sources):
+    import time
+
+    fetch_weather._throttle("OpenWeatherMap")
+    return {"city": city, "time": time.monotonic()}
+
+class TestBatch(unittest.TestCase):
+    def test_batch_ordered(self):
+        cities = [f"City{i}" for i in range(20)]
+        results = list(aggregate_weather_batch(cities, {"OpenWeatherMap": "key"}, processes=2, aggregate=batch_city))
+        self.assertEqual([result["city"] for result in results], cities)
+        self.assertEqual(results[0]["sources"], ["OpenWeatherMap"])
+
+    def test_batch_unordered(self):
+        cities = [f"City{i}" for i in range(20)]
+        results = list(aggregate_weather_batch(cities, {}, processes=3, ordered=False, aggregate=batch_city))
+        self.assertEqual(sorted(result["city"] for result in results), sorted(cities))
+
+    def test_batch_spawn(self):
+        cities = [f"City{i}" for i in range(6)]
+        results = list(aggregate_weather_batch(
+            cities, {"OpenWeatherMap": "key"}, processes=2, aggregate=batch_city, start_method="spawn"
+        ))
+        self.assertEqual([result["city"] for result in results], cities)
+
+    def test_batch_empty(self):
+        self.assertEqual(list(aggregate_weather_batch([], {})), [])
+
+    def test_rate_limits(self):
+        import time
+
+        fetch_weather.set_rate_limits({"OpenWeatherMap": 20})
+        try:
+            start = time.monotonic()
+            for _ in range(30):
+                fetch_weather._throttle("OpenWeatherMap")
+            elapsed = time.monotonic() - start
+        finally:
+            fetch_weather.set_rate_limits({})
+        # The first 20 calls use the burst, the other 10 have to wait 1/20 s each
+        self.assertGreaterEqual(elapsed, 0.45)
+        self.assertLess(elapsed, 1.5)
+
+    def test_init_worker_shares_quotas(self):
+        import batch
+
+        shared = {"OpenWeatherMap": fetch_weather.RateLimiter.shared_state(10)}
+        try:
+            batch._init_worker({}, {"OpenWeatherMap": 10}, shared, batch_city)
+            fetch_weather._throttle("OpenWeatherMap")
+            self.assertEqual(fetch_weather.RATE_LIMITS, {"OpenWeatherMap": 10})
+            self.assertIs(fetch_weather._limiters["OpenWeatherMap"].state, shared["OpenWeatherMap"])
+            self.assertAlmostEqual(shared["OpenWeatherMap"][0], 9, places=1)
+        finally:
+            fetch_weather.set_rate_limits({})
+
+    def test_quota_smaller_than_workers(self):
+        results = list(aggregate_weather_batch(
+            range(4), {}, processes=4, quotas={"OpenWeatherMap": 2}, aggregate=batch_timed_city
+        ))
+        times = sorted(result["time"] for result in results)
+        # 2 calls of burst for all the workers together, the third one has to wait half a second
+        self.assertGreaterEqual(times[2] - times[0], 0.4)
+
+    def test_batch_holds_global_quota(self):
+        import time
+
+        start = time.monotonic()
+        results = list(aggregate_weather_batch(
+            range(80), {}, processes=2, quotas={"OpenWeatherMap": 40}, aggregate=batch_throttled_city
+        ))
+        elapsed = time.monotonic() - start
+        self.assertEqual(len(results), 80)
+        # The workers share 40 calls of burst, the other 40 calls take a second at 40 per second
+        self.assertGreaterEqual(elapsed, 0.9)
+
+class TestRollingStats(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.stats = RollingStats(window=60, clock=lambda: self.now)
+
+    def test_summary(self):
+        for i, value in enumerate([10, 20, 30]):
+            self.stats.add("CityA", "current_temp", "OpenWeatherMap", value, timestamp=self.now - 10 + i)
+        summary = self.stats.summary("CityA", "current_temp")
+        self.assertEqual(summary["count"], 3)
+        self.assertAlmostEqual(summary["mean"], 20)
+        self.assertAlmostEqual(summary["variance"], 200 / 3)
+        self.assertEqual(summary["min"], 10)
+        self.assertEqual(summary["max"], 30)
+
+    def test_window_expires(self):
+        self.stats.add("CityA", "current_temp", "OpenWeatherMap", 5, timestamp=self.now - 100)
+        self.stats.add("CityA", "current_temp", "OpenWeatherMap", 15, timestamp=self.now - 5)
+        summary = self.stats.summary("CityA", "current_temp")
+        self.assertEqual(summary["count"], 1)
+        self.assertEqual(summary["min"], 15)
+        self.now += 100
+        self.assertIsNone(self.stats.summary("CityA", "current_temp"))
+
+    def test_out_of_order_timestamps(self):
+        self.now = 120.0
+        self.stats.add("CityA", "current_temp", "OpenWeatherMap", 5, timestamp=100)
+        self.stats.add("CityA", "current_temp", "WeatherAPI", 1, timestamp=50)
+        summary = self.stats.summary("CityA", "current_temp")
+        self.assertEqual(summary["count"], 2)
+        self.assertEqual(summary["min"], 1)
+        self.assertEqual(summary["max"], 5)
+        self.assertEqual(summary["providers"], 2)
+
+        # The late value was stored at t=100, so both of them expire together
+        self.now = 155.0
+        self.assertEqual(self.stats.summary("CityA", "current_temp")["count"], 2)
+        self.now = 161.0
+        self.assertIsNone(self.stats.summary("CityA", "current_temp"))
+
+    def test_spread(self):
+        self.stats.add_observation("CityA", "OpenWeatherMap", {"current_temp": 20, "aqi": "N/A"})
+        self.stats.add_observation("CityA", "WeatherAPI", {"current_temp": 23})
+        summary = self.stats.summary("CityA", "current_temp")
+        self.assertEqual(summary["spread"], 3)
+        self.assertEqual(summary["providers"], 2)
+        self.assertEqual(list(self.stats.city_summary("CityA")), ["current_temp"])
+
+    @patch("aggregator.fetch_weather_weatherapi", return_value={"current": {"temp_c": 22, "humidity": 60}})
+    @patch("aggregator.fetch_weather_openweathermap", return_value={
+        "main": {"temp": 20, "temp_max": 25, "temp_min": 15, "humidity": 50}
+    })
+    def test_aggregate_feeds_stats(self, mock_openweathermap, mock_weatherapi):
+        result = aggregate_weather_data("CityA", {"OpenWeatherMap": "key", "WeatherAPI": "key"}, stats=self.stats)
+        self.assertEqual(result["avg_current_temp"], 21)
+        summary = self.stats.summary("CityA", "humidity")
+        self.assertEqual(summary["count"], 2)
+        self.assertEqual(summary["spread"], 10)
+
+    def test_normalize_weather_data(self):
+        values = normalize_weather_data({"currentConditions": {"temp": 20.6, "sunrise": "6:00 AM"}})
+        self.assertEqual(values["current_temp"], 21)
+        self.assertEqual(values["aqi"], "N/A")
+        self.assertEqual(values["sunrise"], "6:00 AM")
+        self.assertIsNone(values["sunset"])
+        self.assertEqual(normalize_weather_data({}), {})
+
+class TestPreferencesStore(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = f"{self.directory.name}/preferences.db"
+        self.store = PreferencesStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_add_and_remove(self):
+        self.assertTrue(self.store.add("CityA", user="alice"))
+        self.assertTrue(self.store.add("CityB", user="alice"))
+        self.assertFalse(self.store.add("CityA", user="alice"))
+        self.assertTrue(self.store.add("CityA", user="bob"))
+        self.assertEqual(self.store.cities("alice"), ["CityA", "CityB"])
+
+        self.assertTrue(self.store.remove("CityA", user="alice"))
+        self.assertFalse(self.store.remove("CityA", user="alice"))
+        self.assertEqual(self.store.cities("alice"), ["CityB"])
+        self.assertTrue(self.store.contains("CityA", user="bob"))
+
+    def test_shared_between_stores(self):
+        other = PreferencesStore(self.path)
+        try:
+            self.store.add("CityA")
+            self.assertEqual(other.cities(), ["CityA"])
+        finally:
+            other.close()
+
+    def test_migrate_from_file(self):
+        import os
+
+        text_file = f"{self.directory.name}/preferred.txt"
+        with open(text_file, "w") as file:
+            file.write("CityA\nCityB\n")
+
+        self.assertEqual(self.store.migrate_from_file(text_file, user="alice"), 2)
+        self.assertEqual(self.store.cities("alice"), ["CityA", "CityB"])
+        self.assertFalse(os.path.exists(text_file))
+        self.assertEqual(self.store.migrate_from_file(text_file, user="alice"), 0)
+
+    def test_migrate_commit_fails(self):
+        import os
+        import sqlite3
+
+        text_file = f"{self.directory.name}/preferred.txt"
+        with open(text_file, "w") as file:
+            file.write("CityA\n")
+
+        class FailingCommit:
+            def __init__(self, connection):
+                self.connection = connection
+
+            def execute(self, sql, *args):
+                if sql == "COMMIT":
+                    raise sqlite3.OperationalError("disk I/O error")
+                return self.connection.execute(sql, *args)
+
+            def __getattr__(self, name):
+                return getattr(self.connection, name)
+
+        real_connection = self.store.connection()
+        with patch.object(self.store, "connection", return_value=FailingCommit(real_connection)):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.store.migrate_from_file(text_file)
+
+        self.assertTrue(os.path.exists(text_file))
+        self.assertEqual(self.store.cities(), [])
+        self.assertEqual(self.store.migrate_from_file(text_file), 1)
+        self.assertEqual(self.store.cities(), ["CityA"])
+
+    def test_migrate_from_several_workers(self):
+        import threading
+
+        text_file = f"{self.directory.name}/preferred.txt"
+        with open(text_file, "w") as file:
+            file.write("CityA\nCityB\n")
+
+        stores = [PreferencesStore(self.path) for _ in range(4)]
+        results = []
+        errors = []
+
+        def migrate(store):
+            try:
+                results.append(store.migrate_from_file(text_file))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                store.close()
+
+        threads = [threading.Thread(target=migrate, args=(store,)) for store in stores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), [0, 0, 0, 2])
+        self.assertEqual(self.store.cities(), ["CityA", "CityB"])
+
+class TestFetchScheduler(unittest.TestCase):
+    def test_interactive_runs_first(self):
+        import threading
+
+        order = []
+        gate = threading.Event()
+        with FetchScheduler(workers=1, reserved=0) as scheduler:
+            blocker = scheduler.submit("bulk", gate.wait)
+            bulk = scheduler.submit("bulk", order.append, "bulk")
+            interactive = scheduler.submit("interactive", order.append, "interactive")
+            gate.set()
+            blocker.result(timeout=5)
+            bulk.result(timeout=5)
+            interactive.result(timeout=5)
+        self.assertEqual(order, ["interactive", "bulk"])
+
+    def test_reserved_workers(self):
+        import threading
+
+        gate = threading.Event()
+        with FetchScheduler(workers=2, reserved=1) as scheduler:
+            scheduler.submit("bulk", gate.wait)
+            waiting = scheduler.submit("bulk", lambda: "bulk")
+            interactive = scheduler.submit("interactive", lambda: "interactive")
+            self.assertEqual(interactive.result(timeout=5), "interactive")
+            self.assertFalse(waiting.done())
+            gate.set()
+            self.assertEqual(waiting.result(timeout=5), "bulk")
+            metrics = scheduler.metrics()
+        self.assertEqual(metrics["interactive"]["submitted"], 1)
+        self.assertEqual(metrics["bulk"]["queued"], 0)
+
+    def test_admission_and_preemption(self):
+        import queue
+        import threading
+
+        started = threading.Event()
+        gate = threading.Event()
+        with FetchScheduler(workers=1, reserved=0, capacity=2, max_queued={"bulk": 2}) as scheduler:
+            scheduler.submit("bulk", lambda: (started.set(), gate.wait()))
+            started.wait(timeout=5)
+            first = scheduler.submit("bulk", lambda: 1)
+            second = scheduler.submit("bulk", lambda: 2)
+            with self.assertRaises(queue.Full):
+                scheduler.submit("bulk", lambda: 3)
+            interactive = scheduler.submit("interactive", lambda: "interactive")
+            self.assertTrue(second.cancelled())
+            gate.set()
+            self.assertEqual(interactive.result(timeout=5), "interactive")
+            self.assertEqual(first.result(timeout=5), 1)
+            metrics = scheduler.metrics()
+        self.assertEqual(metrics["bulk"]["rejected"], 1)
+        self.assertEqual(metrics["bulk"]["preempted"], 1)
+
+    @patch("aggregator.fetch_weather_openweathermap", return_value={
+        "main": {"temp": 20, "temp_max": 25, "temp_min": 15, "humidity": 50}
+    })
+    def test_aggregate_with_preempted_fetch(self, mock_openweathermap):
+        import threading
+        import time
+
+        started = threading.Event()
+        gate = threading.Event()
+        results = []
+        with FetchScheduler(workers=1, reserved=0, capacity=1) as scheduler:
+            scheduler.submit("bulk", lambda: (started.set(), gate.wait()))
+            started.wait(timeout=5)
+            bulk_call = threading.Thread(target=lambda: results.append(
+                aggregate_weather_data("CityA", {"OpenWeatherMap": "key"}, executor=scheduler.executor("bulk"))
+            ))
+            bulk_call.start()
+            deadline = time.monotonic() + 5
+            while scheduler.metrics()["bulk"]["queued"] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            interactive = scheduler.submit("interactive", lambda: "interactive")
+            bulk_call.join(timeout=5)
+            self.assertFalse(bulk_call.is_alive())
+            gate.set()
+            self.assertEqual(interactive.result(timeout=5), "interactive")
+
+        self.assertEqual(results[0]["current_temp"], [])
+        self.assertNotIn("avg_current_temp", results[0])
+        mock_openweathermap.assert_not_called()
+
+    @patch("aggregator.fetch_weather_openweathermap", return_value={
+        "main": {"temp": 20, "temp_max": 25, "temp_min": 15, "humidity": 50}
+    })
+    def test_aggregate_with_scheduler(self, mock_openweathermap):
+        with FetchScheduler(workers=2, reserved=1) as scheduler:
+            result = aggregate_weather_data("CityA", {"OpenWeatherMap": "key"}, executor=scheduler.executor("interactive"))
+        self.assertEqual(result["avg_current_temp"], 20)
+
+def fake_api_response(method, url, *args, **kwargs):
+    """Stands in for requests.Session.request, answers like OpenWeatherMap or WeatherAPI."""
+    import json
+    import requests
+
+    if "openweathermap" in url:
+        body = {"main": {"temp": 20, "temp_max": 25, "temp_min": 15, "humidity": 50}}
+    else:
+        body = {"current": {"temp_c": 22, "humidity": 60}}
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(body).encode("utf-8")
+    response.url = url
+    return response
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = f"{self.directory.name}/weather.jsonl.gz"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_record_and_replay(self):
+        sources = {"OpenWeatherMap": "secret1", "WeatherAPI": "secret2"}
+        with patch("requests.Session.request", side_effect=fake_api_response):
+            with cassette.record(self.path) as session:
+                recorded = aggregate_weather_data("CityA", sources)
+        self.assertEqual(len(session.interactions), 2)
+
+        with open(self.path, "rb") as file:
+            self.assertNotIn(b"secret1", file.read())
+        for interaction in cassette.load_cassette(self.path):
+            self.assertNotIn("secret", interaction["url"])
+
+        with patch("requests.Session.request", side_effect=AssertionError("network used")):
+            with cassette.replay(self.path):
+                replayed = aggregate_weather_data("CityA", sources)
+                missing = aggregate_weather_data("CityB", sources)
+        self.assertEqual(replayed["avg_current_temp"], recorded["avg_current_temp"])
+        self.assertEqual(replayed["avg_humidity"], 55)
+        self.assertEqual(missing["current_temp"], [])
+
+class TestTracing(unittest.TestCase):
+    def test_span_tree(self):
+        with patch("requests.Session.request", side_effect=fake_api_response):
+            with tracing.trace() as tracer:
+                aggregate_weather_data("CityA", {"OpenWeatherMap": "key", "WeatherAPI": "key"})
+
+        roots = tracer.to_json()
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(roots[0]["name"], "aggregate_weather_data")
+        self.assertEqual(roots[0]["attributes"]["target"], "CityA")
+        children = roots[0]["children"]
+        fetches = [child for child in children if child["name"] == "fetch"]
+        self.assertEqual(sorted(fetch["attributes"]["source"] for fetch in fetches), ["OpenWeatherMap", "WeatherAPI"])
+        self.assertEqual([phase["name"] for phase in fetches[0]["children"]], ["throttle", "request", "decode"])
+        self.assertEqual(len([child for child in children if child["name"] == "normalize"]), 2)
+
+        events = tracer.to_chrome_trace()["traceEvents"]
+        self.assertEqual(len(events), 1 + 2 * 4 + 2)
+        self.assertTrue(all(event["ph"] == "X" for event in events))
+
+    def test_disabled(self):
+        self.assertIsNone(tracing._tracer)
+        with tracing.span("nothing") as span:
+            self.assertIsNone(span)
+        function = lambda: None
+        self.assertIs(tracing.wrap(function), function)
+
+    def test_profile(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.prof")
+            with tracing.profile(path):
+                sum(range(1000))
+            self.assertTrue(os.path.exists(path))
+
+class FakeRedisServer:
+    """Tiny in-process server speaking the part of the Redis protocol RedisCache uses."""
+
+    def __init__(self):
+        import socketserver
+        import threading
+        import time
+
+        data = self.data = {}
+        lock = threading.Lock()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def read_command(self):
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                command = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    command.append(self.rfile.read(length + 2)[:-2])
+                return command
+
+            def value(self, key):
+                item = data.get(key)
+                if item is None or item[1] <= time.monotonic():
+                    data.pop(key, None)
+                    return None
+                return item[0]
+
+            def bulk(self, value):
+                return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+            def handle(self):
+                while True:
+                    command = self.read_command()
+                    if command is None:
+                        return
+                    name, args = command[0].upper(), command[1:]
+                    with lock:
+                        if name == b"GET":
+                            reply = self.bulk(self.value(args[0]))
+                        elif name == b"MGET":
+                            reply = b"*%d\r\n" % len(args) + b"".join(self.bulk(self.value(key)) for key in args)
+                        elif name == b"SET":
+                            options = [arg.upper() for arg in args[2:]]
+                            ttl = int(options[options.index(b"PX") + 1]) / 1000 if b"PX" in options else 1e9
+                            if b"NX" in options and self.value(args[0]) is not None:
+                                reply = b"$-1\r\n"
+                            else:
+                                data[args[0]] = (args[1], time.monotonic() + ttl)
+                                reply = b"+OK\r\n"
+                        elif name == b"DEL":
+                            reply = b":%d\r\n" % sum(data.pop(key, None) is not None for key in args)
+                        else:
+                            reply = b"-ERR unknown command\r\n"
+                    self.wfile.write(reply)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        self.cache = RedisCache(port=self.server.port)
+        self.sources = {"OpenWeatherMap": "key"}
+
+    def tearDown(self):
+        self.cache.close()
+        self.server.close()
+
+    def test_redis_commands(self):
+        self.cache.set("a", {"temp": 20}, ttl=60)
+        self.assertEqual(self.cache.get("a"), {"temp": 20})
+        self.assertEqual(self.cache.get_many(["a", "b"]), [{"temp": 20}, None])
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        with self.assertRaises(CacheError):
+            self.cache.execute("PING")
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_incomplete_backend(self):
+        class GetOnlyCache(CacheBackend):
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            GetOnlyCache()
+
+    def test_lock(self):
+        other = RedisCache(port=self.server.port)
+        try:
+            token = self.cache.acquire_lock("CityA", ttl=60)
+            self.assertIsNotNone(token)
+            self.assertIsNone(other.acquire_lock("CityA", ttl=60))
+            other.release_lock("CityA", "wrong token")
+            self.assertIsNone(other.acquire_lock("CityA", ttl=60))
+            self.cache.release_lock("CityA", token)
+            self.assertIsNotNone(other.acquire_lock("CityA", ttl=60))
+        finally:
+            other.close()
+
+    @patch("cache.aggregate_weather_data", side_effect=lambda city, sources: {"city": city, "current_temp": [20]})
+    def test_cached_aggregate_shared(self, mock_aggregate):
+        other = RedisCache(port=self.server.port)
+        try:
+            self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, self.cache)["city"], "CityA")
+            self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, other)["city"], "CityA")
+            results = cached_aggregate_many(["CityA", "CityB", "CityA"], self.sources, other)
+        finally:
+            other.close()
+        self.assertEqual([result["city"] for result in results], ["CityA", "CityB", "CityA"])
+        self.assertEqual(mock_aggregate.call_count, 2)
+
+    @patch("cache.aggregate_weather_data", side_effect=lambda city, sources: {"city": city, "current_temp": [20], "fresh": True})
+    def test_only_lock_holder_refreshes(self, mock_aggregate):
+        cache = MemoryCache()
+        cache.set("CityA:OpenWeatherMap", {"data": {"city": "CityA"}, "fetched_at": 0}, ttl=60)
+        token = cache.acquire_lock("CityA:OpenWeatherMap", ttl=60)
+        self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, cache), {"city": "CityA"})
+        mock_aggregate.assert_not_called()
+        cache.release_lock("CityA:OpenWeatherMap", token)
+        self.assertTrue(cached_aggregate_weather_data("CityA", self.sources, cache)["fresh"])
+
+    def test_empty_result_not_cached(self):
+        empty = {"city": "CityA", "current_temp": []}
+        fresh = {"city": "CityA", "current_temp": [20]}
+        with patch("cache.aggregate_weather_data", return_value=empty):
+            self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, self.cache), empty)
+        self.assertIsNone(self.cache.get("CityA:OpenWeatherMap"))
+        with patch("cache.aggregate_weather_data", return_value=fresh):
+            self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, self.cache), fresh)
+
+    def test_empty_result_keeps_stale_data(self):
+        stale = {"city": "CityA", "current_temp": [18]}
+        self.cache.set("CityA:OpenWeatherMap", {"data": stale, "fetched_at": 0}, ttl=60)
+        with patch("cache.aggregate_weather_data", return_value={"city": "CityA", "current_temp": []}):
+            self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, self.cache), stale)
+        self.assertEqual(self.cache.get("CityA:OpenWeatherMap")["data"], stale)
+
+    @patch("cache.aggregate_weather_data", side_effect=lambda city, sources: {"city": city, "current_temp": [20]})
+    def test_failed_store_does_not_fetch_again(self, mock_aggregate):
+        cache = MemoryCache()
+        with patch.object(cache, "set", side_effect=OSError("connection reset")), \
+                patch.object(cache, "release_lock", side_effect=CacheError("ERR")):
+            result = cached_aggregate_weather_data("CityA", self.sources, cache)
+        self.assertEqual(result["current_temp"], [20])
+        self.assertEqual(mock_aggregate.call_count, 1)
+
+    @patch("cache.aggregate_weather_data", side_effect=lambda city, sources: {"city": city})
+    def test_cache_down(self, mock_aggregate):
+        self.server.close()
+        self.cache.close()
+        self.assertEqual(cached_aggregate_weather_data("CityA", self.sources, self.cache), {"city": "CityA"})
+
+class TestAdaptiveFanout(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.openweathermap = {"main": {"temp": 20, "temp_max": 25, "temp_min": 15, "humidity": 50}}
+        self.weatherapi = {"current": {"temp_c": 20, "humidity": 60}}
+        patcher_openweathermap = patch("aggregator.fetch_weather_openweathermap", side_effect=self.slow_openweathermap)
+        patcher_weatherapi = patch("aggregator.fetch_weather_weatherapi", side_effect=lambda city, key: self.weatherapi)
+        self.mock_openweathermap = patcher_openweathermap.start()
+        self.mock_weatherapi = patcher_weatherapi.start()
+        self.addCleanup(patch.stopall)
+        self.fanout = AdaptiveFanout(
+            {"OpenWeatherMap": "key", "WeatherAPI": "key"}, threshold=1, min_full_runs=2, max_age=100,
+            clock=lambda: self.now,
+        )
+
+    def slow_openweathermap(self, city, key):
+        import time
+
+        time.sleep(0.02)
+        return self.openweathermap
+
+    def slow_visualcrossing(self, answer):
+        def fetch(city, key):
+            import time
+
+            time.sleep(0.01)
+            return answer
+        return fetch
+
+    def test_skips_calls_when_providers_agree(self):
+        for _ in range(2):
+            self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 0)
+
+        result = self.fanout.aggregate("CityA")
+        self.assertEqual(result["fanout"]["queried"], ["WeatherAPI"])
+        self.assertEqual(result["fanout"]["skipped"], 1)
+        self.assertEqual(result["avg_current_temp"], 20)
+        self.assertEqual(self.mock_openweathermap.call_count, 2)
+
+        report = self.fanout.report()
+        self.assertEqual(report["calls_saved"], 1)
+        self.assertEqual(report["calls_made"], 5)
+
+    def test_threshold_is_inclusive(self):
+        self.weatherapi = {"current": {"temp_c": 21, "humidity": 60}}
+        for _ in range(2):
+            self.fanout.aggregate("CityA")
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 1)
+
+    def test_subset_keeps_every_field(self):
+        visualcrossing = {"currentConditions": {"temp": 20, "aqi": 42, "sunrise": "6:00 AM", "sunset": "8:00 PM"}}
+        patch("aggregator.fetch_weather_visualcrossing", side_effect=self.slow_visualcrossing(visualcrossing)).start()
+        fanout = AdaptiveFanout(
+            {"OpenWeatherMap": "key", "VisualCrossing": "key", "WeatherAPI": "key"}, min_full_runs=2,
+            clock=lambda: self.now,
+        )
+        for _ in range(2):
+            fanout.aggregate("CityA")
+
+        result = fanout.aggregate("CityA")
+        self.assertEqual(result["fanout"]["queried"], ["WeatherAPI", "VisualCrossing"])
+        self.assertEqual(result["fanout"]["skipped"], 1)
+        self.assertEqual(result["aqi"], [42])
+        self.assertEqual(result["sunrise"], "6:00 AM")
+        self.assertEqual(result["avg_high_temp"], 20)
+        self.assertEqual(result["avg_humidity"], 60)
+
+    def test_escalates_when_partial_value_diverges(self):
+        for _ in range(2):
+            self.fanout.aggregate("CityA")
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 1)
+
+        self.weatherapi = {"current": {"temp_c": 30, "humidity": 60}}
+        result = self.fanout.aggregate("CityA")
+        self.assertEqual(result["fanout"]["skipped"], 0)
+        self.assertEqual(result["fanout"]["estimated_error"], 10)
+        self.assertEqual(result["avg_current_temp"], 25)
+        self.assertEqual(self.fanout.report()["escalations"], 1)
+
+    def test_escalates_on_slow_drift(self):
+        self.fanout.threshold = 2
+        for _ in range(2):
+            self.fanout.aggregate("CityA")
+
+        # Every step is within the threshold, the total drift since the last full fan-out is not
+        for temp in (21, 22):
+            self.weatherapi = {"current": {"temp_c": temp, "humidity": 60}}
+            result = self.fanout.aggregate("CityA")
+            self.assertEqual(result["fanout"]["skipped"], 1)
+            self.assertEqual(result["fanout"]["estimated_error"], temp - 20)
+
+        self.weatherapi = {"current": {"temp_c": 23, "humidity": 60}}
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 0)
+        self.assertEqual(self.fanout.report()["escalations"], 1)
+
+    def test_full_fanout_reports_spread(self):
+        self.weatherapi = {"current": {"temp_c": 21, "humidity": 60}}
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["estimated_error"], 1)
+
+    def test_full_fanout_when_providers_disagree(self):
+        self.weatherapi = {"current": {"temp_c": 25, "humidity": 60}}
+        for _ in range(4):
+            result = self.fanout.aggregate("CityA")
+            self.assertEqual(result["fanout"]["skipped"], 0)
+        self.assertEqual(self.fanout.report()["calls_saved"], 0)
+
+    def test_confidence_decays(self):
+        for _ in range(2):
+            self.fanout.aggregate("CityA")
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 1)
+        self.now += 1000
+        self.assertEqual(self.fanout.aggregate("CityA")["fanout"]["skipped"], 0)
+
+    def test_escalates_on_empty_answer(self):
+        for _ in range(2):
+            self.fanout.aggregate("CityA")
+        self.weatherapi = None
+        result = self.fanout.aggregate("CityA")
+        self.assertEqual(result["fanout"]["skipped"], 0)
+        self.assertEqual(result["avg_current_temp"], 20)
+        self.assertEqual(self.fanout.report()["escalations"], 1)
+
 if __name__ == "__main__":
     unittest.main()
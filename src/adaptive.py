@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import deque
+
+from aggregator import aggregate_weather_data
+
+
+class _Observer:
+    """Collects the answers of one aggregate_weather_data call and when each of them arrived."""
+
+    def __init__(self, started, stats):
+        self.started = started
+        self.stats = stats
+        self.values = {}
+        self.latencies = {}
+
+    def add_observation(self, city, provider, values):
+        self.latencies[provider] = time.monotonic() - self.started
+        self.values[provider] = values
+        if self.stats is not None:
+            self.stats.add_observation(city, provider, values)
+
+
+class AdaptiveFanout:
+    """Asks only the fastest APIs for a city while all the APIs keep agreeing on it.
+
+    Every city starts with the full fan-out. When the last `history` full fan-outs (at least `min_full_runs`)
+    all had a spread of `field` of at most `threshold`, only the fastest API is called, plus the fastest one
+    for every field it doesn't have (e.g. Visual Crossing for AQI and sunrise). A partial answer which moves
+    more than `threshold` from the consensus of the last full fan-out, an empty answer or a full fan-out
+    older than `max_age` seconds goes back to calling all of them.
+    """
+
+    def __init__(self, data_sources, threshold=1, history=5, min_full_runs=3, max_age=3600,
+                 field="current_temp", smoothing=0.3, stats=None, clock=time.time):
+        self.data_sources = data_sources
+        self.threshold = threshold
+        self.min_full_runs = min_full_runs
+        self.max_age = max_age
+        self.field = field
+        self.smoothing = smoothing
+        self.stats = stats
+        self.clock = clock
+        self.history = history
+        self.spreads = {}
+        self.last_full = {}
+        self.latencies = {}
+        self.coverage = {}
+        self.consensus = {}
+        self.counters = {"calls_made": 0, "calls_saved": 0, "full_runs": 0, "partial_runs": 0, "escalations": 0}
+        self.lock = threading.Lock()
+
+    def _subset(self, city):
+        """Fastest APIs of the city which still give every field, None if we can't skip any of them."""
+        spreads = self.spreads.get(city)
+        if not spreads or len(spreads) < self.min_full_runs or max(spreads) > self.threshold:
+            return None
+        if self.clock() - self.last_full[city] > self.max_age:
+            return None
+        coverage = self.coverage[city]
+        known = [source for source in self.data_sources if source in coverage and (city, source) in self.latencies]
+        known.sort(key=lambda source: self.latencies[(city, source)])
+        fields = set().union(*coverage.values())
+        subset = []
+        covered = set()
+        for source in known:
+            if not subset or coverage[source] - covered:
+                subset.append(source)
+                covered |= coverage[source]
+            if covered >= fields:
+                break
+        if not subset or len(subset) == len(self.data_sources):
+            return None
+        return subset
+
+    def _fetch(self, city, data_sources):
+        observer = _Observer(time.monotonic(), self.stats)
+        result = aggregate_weather_data(city, data_sources, stats=observer)
+        with self.lock:
+            self.counters["calls_made"] += len(data_sources)
+            for source, latency in observer.latencies.items():
+                previous = self.latencies.get((city, source))
+                self.latencies[(city, source)] = latency if previous is None else (
+                    previous + self.smoothing * (latency - previous)
+                )
+        return result, observer
+
+    def aggregate(self, city):
+        """aggregate_weather_data for the city with as few API calls as we can afford.
+
+        The result gets a "fanout" dict with the queried APIs, how many calls were skipped and
+        the estimated error: the spread between the APIs for a full fan-out, otherwise the largest recent one
+        plus how far the partial answer moved from the last full fan-out.
+        """
+        with self.lock:
+            subset = self._subset(city)
+            estimated_error = max(self.spreads[city]) if subset is not None else 0
+
+        if subset is not None:
+            result, observer = self._fetch(city, {source: self.data_sources[source] for source in subset})
+            values = self._values(observer)
+            if values:
+                mean = sum(values) / len(values)
+                with self.lock:
+                    # Always compare with the last full fan-out, otherwise a slow drift never escalates
+                    offset = abs(mean - self.consensus[city])
+                    if offset <= self.threshold:
+                        skipped = len(self.data_sources) - len(subset)
+                        self.counters["partial_runs"] += 1
+                        self.counters["calls_saved"] += skipped
+                        result["fanout"] = {
+                            "queried": subset, "skipped": skipped, "estimated_error": estimated_error + offset
+                        }
+                        return result
+            with self.lock:
+                self.counters["escalations"] += 1
+
+        result, observer = self._fetch(city, self.data_sources)
+        values = self._values(observer)
+        spread = max(values) - min(values) if len(values) > 1 else None
+        with self.lock:
+            self.counters["full_runs"] += 1
+            if spread is not None:
+                self.spreads.setdefault(city, deque(maxlen=self.history)).append(spread)
+                self.last_full[city] = self.clock()
+                self.consensus[city] = sum(values) / len(values)
+                self.coverage[city] = {
+                    source: {field for field, value in answer.items() if value is not None}
+                    for source, answer in observer.values.items()
+                }
+        result["fanout"] = {"queried": list(self.data_sources), "skipped": 0, "estimated_error": spread or 0}
+        return result
+
+    def _values(self, observer):
+        """Values of `field` from every API which answered."""
+        return [values[self.field] for values in observer.values.values() if self.field in values]
+
+    def report(self):
+        """Calls made and saved so far, full and partial runs and how many partial runs had to escalate."""
+        with self.lock:
+            return dict(self.counters)
@@ -1,10 +1,40 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
+import tracing
 from fetch_weather import fetch_weather_visualcrossing, fetch_weather_openweathermap, fetch_weather_weatherapi
 
 
-def aggregate_weather_data(city, data_sources):
-    """Agregated data from the Weather APIs"""
+def normalize_weather_data(data):
+    """Turn the answer of one Weather API into a dict of our own field names."""
+    values = {}
+    """As Weather APIs have different formats, we need to find them by their name"""
+    if "main" in data:  # OpenWeatherMap format
+        values["current_temp"] = round(data["main"]["temp"])
+        values["high_temp"] = round(data["main"]["temp_max"])
+        values["low_temp"] = round(data["main"]["temp_min"])
+        values["humidity"] = round(data["main"]["humidity"])
+    elif "currentConditions" in data:  # Visual Crossing format
+        current = data["currentConditions"]
+        values["current_temp"] = round(current.get("temp"))
+        values["aqi"] = current.get("aqi", "N/A")
+        values["sunrise"] = current.get("sunrise")
+        values["sunset"] = current.get("sunset")
+    elif "current" in data:  # WeatherAPI format
+        current = data["current"]
+        values["current_temp"] = round(current["temp_c"])
+        values["high_temp"] = round(current["temp_c"])
+        values["low_temp"] = round(current["temp_c"])
+        values["humidity"] = round(current["humidity"])
+    return values
+
+@tracing.traced("aggregate_weather_data")
+def aggregate_weather_data(city, data_sources, stats=None, executor=None):
+    """Agregated data from the Weather APIs
+
+    If stats is given (see rolling_stats.RollingStats), every answer is also fed into it as soon as it arrives.
+    The fetching runs in a new ThreadPoolExecutor, unless an executor (e.g. scheduler.FetchScheduler.executor()) is given.
+    """
     aggregated_data = {
         "city": city,
         "current_temp": [],
@@ -16,37 +46,33 @@ def aggregate_weather_data(city, data_sources):
         "sunset": None
     }
     """It start 3 thread at the same time, they try to get weather data."""
-    with ThreadPoolExecutor() as executor:
-        futures = []
+    with nullcontext(executor) if executor is not None else ThreadPoolExecutor() as executor:
+        futures = {}
         for source, api_key in data_sources.items():
             if source == "OpenWeatherMap":
-                futures.append(executor.submit(fetch_weather_openweathermap, city, api_key))
+                futures[executor.submit(tracing.wrap(fetch_weather_openweathermap), city, api_key)] = source
             elif source == "VisualCrossing":
-                futures.append(executor.submit(fetch_weather_visualcrossing, city, api_key))
+                futures[executor.submit(tracing.wrap(fetch_weather_visualcrossing), city, api_key)] = source
             elif source == "WeatherAPI":
-                futures.append(executor.submit(fetch_weather_weatherapi, city, api_key))
+                futures[executor.submit(tracing.wrap(fetch_weather_weatherapi), city, api_key)] = source
 
         for future in as_completed(futures):
-            data = future.result()
+            try:
+                data = future.result()
+            except CancelledError:
+                # The scheduler dropped the fetch, the source is just missing
+                data = None
             if data:
-                """As Weather APIs have different formats, we need to find them by their name"""
-                if "main" in data:  # OpenWeatherMap format
-                    aggregated_data["current_temp"].append(round(data["main"]["temp"]))
-                    aggregated_data["high_temp"].append(round(data["main"]["temp_max"]))
-                    aggregated_data["low_temp"].append(round(data["main"]["temp_min"]))
-                    aggregated_data["humidity"].append(round(data["main"]["humidity"]))
-                elif "currentConditions" in data:  # Visual Crossing format
-                    current = data["currentConditions"]
-                    aggregated_data["current_temp"].append(round(current.get("temp")))
-                    aggregated_data["aqi"].append(current.get("aqi", "N/A"))
-                    aggregated_data["sunrise"] = current.get("sunrise")
-                    aggregated_data["sunset"] = current.get("sunset")
-                elif "current" in data:  # WeatherAPI format
-                    current = data["current"]
-                    aggregated_data["current_temp"].append(round(current["temp_c"]))
-                    aggregated_data["high_temp"].append(round(current["temp_c"]))
-                    aggregated_data["low_temp"].append(round(current["temp_c"]))
-                    aggregated_data["humidity"].append(round(current["humidity"]))
+                with tracing.span("normalize", source=futures[future]):
+                    values = normalize_weather_data(data)
+                if stats is not None and values:
+                    stats.add_observation(city, futures[future], values)
+                for field in ("current_temp", "high_temp", "low_temp", "humidity", "aqi"):
+                    if field in values:
+                        aggregated_data[field].append(values[field])
+                if "sunrise" in values:
+                    aggregated_data["sunrise"] = values["sunrise"]
+                    aggregated_data["sunset"] = values["sunset"]
 
     """Aggregating data."""
     if aggregated_data["current_temp"]:
@@ -0,0 +1,56 @@
+import logging
+import multiprocessing
+import os
+
+import fetch_weather
+from aggregator import aggregate_weather_data
+
+_data_sources = None
+_aggregate = None
+
+def _init_worker(data_sources, quotas, shared, aggregate):
+    """Every worker gets its own session, the rate limits are shared by all of them."""
+    global _data_sources, _aggregate
+    fetch_weather.set_session(None)
+    fetch_weather.set_rate_limits(quotas, shared)
+    _data_sources = data_sources
+    _aggregate = aggregate
+
+def _aggregate_city(city):
+    """Runs inside the worker, one city at a time."""
+    try:
+        return _aggregate(city, _data_sources)
+    except Exception as e:
+        logging.error(f"Batch worker failed for {city}: {e}")
+        return {"city": city, "error": str(e)}
+
+def aggregate_weather_batch(cities, data_sources, processes=None, ordered=True, quotas=None, chunksize=None,
+                            aggregate=aggregate_weather_data, start_method=None):
+    """Aggregate weather for a lot of cities, split across a pool of processes.
+
+    quotas are global calls per second for each API. The token buckets live in shared memory,
+    so all the workers together never go over, not even in a burst. Results are yielded as they come back,
+    in the order of cities if ordered is True.
+
+    aggregate is what the workers run for each city, it is sent to them by pickle so it has to be
+    a module level function. start_method ("fork", "spawn"...) picks the multiprocessing context,
+    None means the default of the platform.
+    """
+    cities = list(cities)
+    if not cities:
+        return
+    processes = min(processes or os.cpu_count() or 1, len(cities))
+    if chunksize is None:
+        chunksize = max(1, len(cities) // (processes * 4))
+
+    context = multiprocessing.get_context(start_method)
+    quotas = quotas or {}
+    shared = {source: fetch_weather.RateLimiter.shared_state(rate, context=context) for source, rate in quotas.items()}
+    initargs = (data_sources, quotas, shared, aggregate)
+    with context.Pool(processes, _init_worker, initargs) as pool:
+        if ordered:
+            results = pool.imap(_aggregate_city, cities, chunksize)
+        else:
+            results = pool.imap_unordered(_aggregate_city, cities, chunksize)
+        for result in results:
+            yield result
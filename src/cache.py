@@ -0,0 +1,281 @@
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from aggregator import aggregate_weather_data
+
+
+class CacheError(Exception):
+    """The cache server answered with an error."""
+
+
+class CacheBackend(ABC):
+    """What a cache has to do, values are anything json can store."""
+
+    @abstractmethod
+    def get(self, key):
+        """Value of the key, None if it is missing or expired."""
+
+    def get_many(self, keys):
+        """Values of all the keys in one go, None for the missing ones."""
+        return [self.get(key) for key in keys]
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Store the value for ttl seconds."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove the key if it is there."""
+
+    @abstractmethod
+    def acquire_lock(self, name, ttl):
+        """Take a lock for ttl seconds, returns a token for release_lock() or None if somebody else has it."""
+
+    @abstractmethod
+    def release_lock(self, name, token):
+        """Release the lock, only if it is still held with this token."""
+
+
+class MemoryCache(CacheBackend):
+    """Cache inside this process, for a single instance or tests."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires <= self.clock():
+            del self.items[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def get_many(self, keys):
+        with self.lock:
+            return [self._get(key) for key in keys]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items[key] = (value, self.clock() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def acquire_lock(self, name, ttl):
+        token = uuid.uuid4().hex
+        with self.lock:
+            if self._get("lock:" + name) is not None:
+                return None
+            self.items["lock:" + name] = (token, self.clock() + ttl)
+        return token
+
+    def release_lock(self, name, token):
+        with self.lock:
+            if self._get("lock:" + name) == token:
+                del self.items["lock:" + name]
+
+
+class RedisCache(CacheBackend):
+    """Cache shared by all the instances, talks the Redis protocol (RESP) over a plain socket.
+
+    Only GET, MGET, SET (with NX and PX) and DEL are used, so Redis, Valkey, KeyDB... all work.
+    """
+
+    def __init__(self, host="localhost", port=6379, timeout=5, prefix="weather:"):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.prefix = prefix
+        self.sock = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.file = self.sock.makefile("rb")
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.file.close()
+                self.sock.close()
+                self.sock = self.file = None
+
+    @staticmethod
+    def _encode(command):
+        parts = [str(part).encode("utf-8") if not isinstance(part, bytes) else part for part in command]
+        return b"*%d\r\n" % len(parts) + b"".join(b"$%d\r\n%s\r\n" % (len(part), part) for part in parts)
+
+    def _read_reply(self):
+        line = self.file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Cache server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise CacheError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            return self.file.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise CacheError(f"Unknown reply {line!r}")
+
+    def pipeline(self, commands):
+        """Send all the commands at once and read all the replies, one round trip for the whole batch."""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    self.sock.sendall(b"".join(self._encode(command) for command in commands))
+                    replies = []
+                    for _ in commands:
+                        # Read every reply even after an error, otherwise the next call gets the rest of them
+                        try:
+                            replies.append(self._read_reply())
+                        except CacheError as e:
+                            replies.append(e)
+                    break
+                except OSError:
+                    if self.sock is not None:
+                        self.file.close()
+                        self.sock.close()
+                        self.sock = self.file = None
+                    if attempt:
+                        raise
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+        return replies
+
+    def execute(self, *command):
+        return self.pipeline([command])[0]
+
+    @staticmethod
+    def _load(raw):
+        return json.loads(raw) if raw is not None else None
+
+    def get(self, key):
+        return self._load(self.execute("GET", self.prefix + key))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [self._load(raw) for raw in self.execute("MGET", *[self.prefix + key for key in keys])]
+
+    def set(self, key, value, ttl):
+        self.execute("SET", self.prefix + key, json.dumps(value), "PX", int(ttl * 1000))
+
+    def delete(self, key):
+        self.execute("DEL", self.prefix + key)
+
+    def acquire_lock(self, name, ttl):
+        token = uuid.uuid4().hex
+        reply = self.execute("SET", self.prefix + "lock:" + name, token, "NX", "PX", int(ttl * 1000))
+        return token if reply == "OK" else None
+
+    def release_lock(self, name, token):
+        # Check and delete are two commands, the lock expires on its own if we are too slow anyway
+        key = self.prefix + "lock:" + name
+        if self.execute("GET", key) == token.encode("utf-8"):
+            self.execute("DEL", key)
+
+
+def _cache_key(city, data_sources):
+    return f"{city}:{','.join(sorted(data_sources))}"
+
+def _refresh(city, data_sources, cache, ttl, stale_ttl, lock_ttl, entry):
+    """Fetch the city again, only the instance holding the lock does it, the others get the old data."""
+    key = _cache_key(city, data_sources)
+    token = cache.acquire_lock(key, lock_ttl)
+    if token is None:
+        if entry is not None:
+            return entry["data"]
+        # Nothing to fall back to, wait for the instance which is fetching it.
+        # If it lets the lock go without caching anything (all APIs failed), we try ourselves.
+        deadline = time.monotonic() + lock_ttl
+        while token is None:
+            if time.monotonic() >= deadline:
+                return aggregate_weather_data(city, data_sources)
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry["data"]
+            token = cache.acquire_lock(key, lock_ttl)
+    try:
+        data = aggregate_weather_data(city, data_sources)
+        if not data["current_temp"]:
+            # Every API failed, don't share that with the other instances, the old data is better if we have it
+            logging.warning(f"No weather data for {city}, not caching it.")
+            return entry["data"] if entry is not None else data
+        # We have the data now, a broken cache must not make us fetch it again
+        try:
+            cache.set(key, {"data": data, "fetched_at": time.time()}, ttl + stale_ttl)
+        except (CacheError, OSError) as e:
+            logging.error(f"Cache error while storing {city}: {e}")
+        return data
+    finally:
+        try:
+            cache.release_lock(key, token)
+        except (CacheError, OSError) as e:
+            logging.error(f"Cache error while releasing the lock for {city}: {e}")
+
+def _from_entry(city, data_sources, cache, entry, ttl, stale_ttl, lock_ttl):
+    """Use the cached entry if it is fresh, otherwise refresh it. Without a working cache the data is fetched directly."""
+    if entry is not None and time.time() - entry["fetched_at"] < ttl:
+        return entry["data"]
+    try:
+        return _refresh(city, data_sources, cache, ttl, stale_ttl, lock_ttl, entry)
+    except (CacheError, OSError) as e:
+        logging.error(f"Cache error for {city}: {e}")
+        return aggregate_weather_data(city, data_sources)
+
+def cached_aggregate_weather_data(city, data_sources, cache, ttl=600, stale_ttl=3600, lock_ttl=30):
+    """aggregate_weather_data, but the result is shared through the cache for ttl seconds.
+
+    After ttl one instance fetches it again while the others keep serving the old data for up to stale_ttl.
+    """
+    try:
+        entry = cache.get(_cache_key(city, data_sources))
+    except (CacheError, OSError) as e:
+        logging.error(f"Cache error for {city}: {e}")
+        entry = None
+    return _from_entry(city, data_sources, cache, entry, ttl, stale_ttl, lock_ttl)
+
+def cached_aggregate_many(cities, data_sources, cache, ttl=600, stale_ttl=3600, lock_ttl=30, workers=8):
+    """The same for a list of cities, all of them are looked up with one multi-get."""
+    cities = list(cities)
+    try:
+        entries = cache.get_many([_cache_key(city, data_sources) for city in cities])
+    except (CacheError, OSError) as e:
+        logging.error(f"Cache error: {e}")
+        entries = [None] * len(cities)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda city, entry: _from_entry(city, data_sources, cache, entry, ttl, stale_ttl, lock_ttl), cities, entries
+        ))
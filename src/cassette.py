@@ -0,0 +1,126 @@
+import gzip
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+import requests
+
+import fetch_weather
+
+"""API keys are never written to a cassette."""
+_SECRET = re.compile(r"(\b(?:key|appid)=)[^&]*")
+
+
+def _redact(url):
+    return _SECRET.sub(r"\1***", url)
+
+def load_cassette(path):
+    """Read the recorded interactions, one JSON object per line of a gzip file."""
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def save_cassette(path, interactions):
+    """Write the interactions in the same format load_cassette reads."""
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        for interaction in interactions:
+            file.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+
+
+class RecordingSession(requests.Session):
+    """Real session which also remembers every answer and how long it took."""
+
+    def __init__(self):
+        super().__init__()
+        self.interactions = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        interaction = {"method": method.upper(), "url": _redact(url)}
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException as e:
+            interaction["error"] = str(e)
+            interaction["latency"] = time.monotonic() - start
+            with self.lock:
+                self.interactions.append(interaction)
+            raise
+        interaction["latency"] = time.monotonic() - start
+        interaction["status"] = response.status_code
+        interaction["content_type"] = response.headers.get("Content-Type", "application/json")
+        interaction["body"] = response.content.decode("utf-8", errors="replace")
+        with self.lock:
+            self.interactions.append(interaction)
+        return response
+
+
+class ReplaySession(requests.Session):
+    """Serves the answers from a cassette instead of calling the APIs.
+
+    With realtime=True every answer waits as long as the recorded one did, otherwise it is returned at once.
+    Repeated requests get the recorded answers in order, starting again from the first one when they run out.
+    """
+
+    def __init__(self, interactions, realtime=False):
+        super().__init__()
+        self.realtime = realtime
+        self.lock = threading.Lock()
+        self.recorded = {}
+        for interaction in interactions:
+            self.recorded.setdefault((interaction["method"], interaction["url"]), []).append(interaction)
+        self.pending = {key: deque(items) for key, items in self.recorded.items()}
+
+    def request(self, method, url, *args, **kwargs):
+        key = (method.upper(), _redact(url))
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                raise requests.ConnectionError(f"No recorded answer for {key[1]}")
+            if not pending:
+                pending.extend(self.recorded[key])
+            interaction = pending.popleft()
+
+        if self.realtime:
+            time.sleep(interaction["latency"])
+        if "error" in interaction:
+            raise requests.ConnectionError(interaction["error"])
+
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response._content = interaction["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.headers["Content-Type"] = interaction["content_type"]
+        response.url = interaction["url"]
+        response.elapsed = timedelta(seconds=interaction["latency"])
+        return response
+
+
+@contextmanager
+def record(path):
+    """Everything the fetchers get inside the block is saved to the cassette at path."""
+    previous = fetch_weather.get_session()
+    session = RecordingSession()
+    fetch_weather.set_session(session)
+    try:
+        yield session
+    finally:
+        fetch_weather.set_session(previous)
+        save_cassette(path, session.interactions)
+
+@contextmanager
+def replay(path, realtime=False):
+    """The fetchers get their answers from the cassette at path, no network is used.
+
+    It only changes the session of this process, the workers of batch.aggregate_weather_batch make their own.
+    """
+    previous = fetch_weather.get_session()
+    session = ReplaySession(load_cassette(path), realtime)
+    fetch_weather.set_session(session)
+    try:
+        yield session
+    finally:
+        fetch_weather.set_session(previous)
@@ -1,17 +1,113 @@
 import logging
+import multiprocessing
+import threading
+import time
 
 import requests
 
+import tracing
 from api_keys import ENDPOINTS
 
+"""Calls per second allowed for each API in this process, empty means no limit."""
+RATE_LIMITS = {}
+
+_session = None
+_limiters = {}
+_shared_states = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Simple token bucket, so we don't go over the quota of an API.
+
+    With a shared state from shared_state() the bucket lives in shared memory, so several
+    processes using it all take their calls from one quota.
+    """
+
+    def __init__(self, rate, burst=None, shared=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        if shared is None:
+            self.state = [self.capacity, time.monotonic()]
+            self.lock = threading.Lock()
+        else:
+            self.state = shared
+            self.lock = shared.get_lock()
+
+    @staticmethod
+    def shared_state(rate, burst=None, context=multiprocessing):
+        """Bucket (tokens, last update) in shared memory, give it to the processes when they start."""
+        capacity = burst if burst is not None else max(1.0, rate)
+        return context.Array("d", [capacity, time.monotonic()])
+
+    def acquire(self):
+        """Wait until we are allowed to make one call."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens = min(self.capacity, self.state[0] + (now - self.state[1]) * self.rate)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session():
+    """Return the HTTP session of this process, so connections get reused."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+def set_session(session):
+    """Replace the HTTP session, None means a fresh one is created on the next call."""
+    global _session
+    _session = session
+
+def set_rate_limits(limits, shared=None):
+    """Set calls per second for each API and reset the current buckets.
+
+    shared maps an API to a RateLimiter.shared_state(), its bucket is then shared with other processes.
+    """
+    with _limiters_lock:
+        RATE_LIMITS.clear()
+        RATE_LIMITS.update(limits)
+        _shared_states.clear()
+        _shared_states.update(shared or {})
+        _limiters.clear()
+
+def _throttle(source):
+    """Block until the rate limit of the source lets us through."""
+    rate = RATE_LIMITS.get(source)
+    if not rate:
+        return
+    with _limiters_lock:
+        limiter = _limiters.get(source)
+        if limiter is None:
+            limiter = _limiters[source] = RateLimiter(rate, shared=_shared_states.get(source))
+    limiter.acquire()
+
+def _request(source, city, url):
+    """GET the url and decode the JSON, every phase gets its own span when tracing is on."""
+    with tracing.span("fetch", source=source, city=city):
+        with tracing.span("throttle"):
+            _throttle(source)
+        with tracing.span("request") as span:
+            response = get_session().get(url)
+            if span is not None:
+                span.attributes.update(status=response.status_code, time_to_headers_ms=response.elapsed.total_seconds() * 1000)
+        response.raise_for_status()
+        with tracing.span("decode", size=len(response.content)):
+            return response.json()
 
 def fetch_weather_openweathermap(city, api_key):
     """Fetch weather data from OpenWeatherMap API."""
     try:
         url = f"{ENDPOINTS['OpenWeatherMap']}?q={city}&appid={api_key}&units=metric"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        return _request("OpenWeatherMap", city, url)
     except requests.RequestException as e:
         logging.error(f"OpenWeatherMap API error for {city}: {e}")
         return None
@@ -20,9 +116,7 @@ def fetch_weather_visualcrossing(city, api_key):
     """Fetch weather data from Visual Crossing API."""
     try:
         url = f"{ENDPOINTS['VisualCrossing']}/{city}?unitGroup=metric&key={api_key}&include=current,fcst&elements=tempmax,tempmin,temp,humidity,aqi,sunrise,sunset"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        return _request("VisualCrossing", city, url)
     except requests.RequestException as e:
         logging.error(f"Visual Crossing API error for {city}: {e}")
         return None
@@ -31,9 +125,7 @@ def fetch_weather_weatherapi(city, api_key):
     """Fetch weather data from WeatherAPI."""
     try:
         url = f"{ENDPOINTS['WeatherAPI']}?key={api_key}&q={city}&aqi=yes"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        return _request("WeatherAPI", city, url)
     except requests.RequestException as e:
         logging.error(f"WeatherAPI error for {city}: {e}")
         return None
@@ -1,8 +1,10 @@
 import csv
+import os
 import sys
 
 import requests
 
+import tracing
 from aggregator import aggregate_weather_data
 from api_keys import API_KEYS
 from preferences import *
@@ -27,11 +29,10 @@ def menu():
     print("4) Exit")
     return input()
 
-def modify_preferences():
+def modify_preferences(store):
     """The user can Add and Delete city from the Preferences."""
-    preferences = load_preferences()
-
     while True:
+        preferences = store.cities()
         print("\nPreferred Cities:")
         for i, city in enumerate(preferences, 1):
             print(f"{i}) {city}")
@@ -44,9 +45,7 @@ def modify_preferences():
 
         if choice == "1":
             new_city = input("What is the name of the city?: ").strip()
-            if new_city and new_city not in preferences:
-                preferences.append(new_city)
-                save_preferences(preferences)
+            if new_city and store.add(new_city):
                 print(f"{new_city} has beenadded to preferences.")
             else:
                 print("City already exists or invalid input.")
@@ -54,8 +53,8 @@ def modify_preferences():
             try:
                 city_index = int(input("Enter the number of the city to delete: ").strip()) - 1
                 if 0 <= city_index < len(preferences):
-                    removed_city = preferences.pop(city_index)
-                    save_preferences(preferences)
+                    removed_city = preferences[city_index]
+                    store.remove(removed_city)
                     print(f"{removed_city} succesfully removed from preferences.")
                 else:
                     print("Invalid choice.")
@@ -71,6 +70,9 @@ def main():
         logging.error("In order to continue, you need to have an internet connection.")
         sys.exit()
 
+    store = PreferencesStore()
+    store.migrate_from_file()
+
     data_sources = {
         "OpenWeatherMap": API_KEYS["OpenWeatherMap"],
         "VisualCrossing": API_KEYS["VisualCrossing"],
@@ -80,7 +82,7 @@ def main():
     while True:
         choice = menu()
         if choice == "1":
-            preferences = load_preferences()
+            preferences = store.cities()
             if preferences:
                 print("\nPreferred Cities:")
                 for i, city in enumerate(preferences, 1):
@@ -126,7 +128,7 @@ def main():
             print("API keys hsve been updated successfully.")
         elif choice == "3":
             print("Accessing preferences...")
-            modify_preferences()
+            modify_preferences(store)
         elif choice == "4":
             print("Goodbye.")
             break
@@ -135,4 +137,15 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    """WEATHER_PROFILE=file runs the program under cProfile, WEATHER_TRACE=file saves a Chrome trace of every fetch."""
+    if os.environ.get("WEATHER_TRACE"):
+        tracing.enable()
+    try:
+        if os.environ.get("WEATHER_PROFILE"):
+            with tracing.profile(os.environ["WEATHER_PROFILE"]):
+                main()
+        else:
+            main()
+    finally:
+        if os.environ.get("WEATHER_TRACE"):
+            tracing.disable().save(os.environ["WEATHER_TRACE"], format="chrome")
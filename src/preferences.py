@@ -1,5 +1,7 @@
 import logging
 import os
+import sqlite3
+import threading
 
 PREFERENCES_FILE = "preferred.txt"
 
@@ -15,4 +17,105 @@ def load_preferences():
 def save_preferences(preferences):
     """Saves preferred cities to a file."""
     with open(PREFERENCES_FILE, "w") as file:
-        file.write("\n".join(preferences))
\ No newline at end of file
+        file.write("\n".join(preferences))
+
+
+PREFERENCES_DB = "preferences.db"
+DEFAULT_USER = "default"
+
+
+class PreferencesStore:
+    """Preferred cities of many users, kept in a SQLite database.
+
+    Every add and remove is one indexed statement, nothing gets rewritten. Each thread gets
+    its own connection and the database runs in WAL mode, so several workers can use it at once.
+    """
+
+    def __init__(self, path=PREFERENCES_DB, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS preferences ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user TEXT NOT NULL, "
+            "city TEXT NOT NULL, "
+            "UNIQUE (user, city))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS preferences_user ON preferences (user, id)")
+
+    def connection(self):
+        """Connection of the current thread, it is opened on the first use."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        """Close the connection of the current thread."""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def cities(self, user=DEFAULT_USER):
+        """Preferred cities of the user, in the order they were added."""
+        rows = self.connection().execute("SELECT city FROM preferences WHERE user = ? ORDER BY id", (user,))
+        return [row[0] for row in rows]
+
+    def contains(self, city, user=DEFAULT_USER):
+        """Check if the user has the city in the preferences."""
+        row = self.connection().execute(
+            "SELECT 1 FROM preferences WHERE user = ? AND city = ?", (user, city)
+        ).fetchone()
+        return row is not None
+
+    def add(self, city, user=DEFAULT_USER):
+        """Add a city, returns False if the user already has it."""
+        cursor = self.connection().execute(
+            "INSERT OR IGNORE INTO preferences (user, city) VALUES (?, ?)", (user, city)
+        )
+        return cursor.rowcount == 1
+
+    def remove(self, city, user=DEFAULT_USER):
+        """Remove a city, returns False if the user didn't have it."""
+        cursor = self.connection().execute(
+            "DELETE FROM preferences WHERE user = ? AND city = ?", (user, city)
+        )
+        return cursor.rowcount == 1
+
+    def migrate_from_file(self, path=PREFERENCES_FILE, user=DEFAULT_USER):
+        """Move the cities from the old text file to the user, the file is renamed afterwards.
+
+        Everything runs inside one write transaction, so when several workers start at once
+        only the first one migrates and the others find the file gone.
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            with open(path, "r") as file:
+                cities = [line.strip() for line in file if line.strip()]
+            connection.executemany(
+                "INSERT OR IGNORE INTO preferences (user, city) VALUES (?, ?)", [(user, city) for city in cities]
+            )
+            os.replace(path, path + ".migrated")
+        except FileNotFoundError:
+            connection.execute("ROLLBACK")
+            return 0
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        try:
+            connection.execute("COMMIT")
+        except Exception:
+            # The cities are not in the database, put the file back so the next start tries again
+            os.replace(path + ".migrated", path)
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        logging.info(f"Migrated {len(cities)} preferred cities from {path}.")
+        return len(cities)
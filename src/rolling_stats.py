@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import deque
+
+"""Fields we keep statistics for, the rest (AQI, sunrise...) is not a number we can average."""
+NUMERIC_FIELDS = ("current_temp", "high_temp", "low_temp", "humidity")
+
+
+class RollingWindow:
+    """Mean, variance, min and max of the values from the last `window` seconds.
+
+    Adding a value and dropping the old ones is O(1) amortized, nothing is ever rescanned.
+    Timestamps older than the newest one already added are moved up to it, so the queues stay in order.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.total = 0.0
+        self.total_squares = 0.0
+        # Monotonic queues, the first item is always the current min/max
+        self.min_queue = deque()
+        self.max_queue = deque()
+        self.newest = None
+
+    def add(self, timestamp, value):
+        """Add a value, returns the timestamp it was stored with."""
+        if self.newest is not None and timestamp < self.newest:
+            timestamp = self.newest
+        self.newest = timestamp
+        self.values.append((timestamp, value))
+        self.total += value
+        self.total_squares += value * value
+        while self.min_queue and self.min_queue[-1][1] > value:
+            self.min_queue.pop()
+        self.min_queue.append((timestamp, value))
+        while self.max_queue and self.max_queue[-1][1] < value:
+            self.max_queue.pop()
+        self.max_queue.append((timestamp, value))
+        self.expire(timestamp)
+        return timestamp
+
+    def expire(self, now):
+        """Drop the values which are older than the window."""
+        oldest = now - self.window
+        while self.values and self.values[0][0] <= oldest:
+            _, value = self.values.popleft()
+            self.total -= value
+            self.total_squares -= value * value
+        while self.min_queue and self.min_queue[0][0] <= oldest:
+            self.min_queue.popleft()
+        while self.max_queue and self.max_queue[0][0] <= oldest:
+            self.max_queue.popleft()
+
+    def summary(self):
+        count = len(self.values)
+        if not count:
+            return None
+        mean = self.total / count
+        return {
+            "count": count,
+            "mean": mean,
+            "variance": max(0.0, self.total_squares / count - mean * mean),
+            "min": self.min_queue[0][1],
+            "max": self.max_queue[0][1],
+        }
+
+
+class RollingStats:
+    """Running statistics per city and field, updated as every API answer arrives.
+
+    Pass it to aggregate_weather_data(city, data_sources, stats=...) and query it with summary().
+    """
+
+    def __init__(self, window=3600, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.windows = {}
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def add(self, city, field, provider, value, timestamp=None):
+        """Add one value of one API."""
+        with self.lock:
+            if timestamp is None:
+                timestamp = self.clock()
+            self._add(city, field, provider, value, timestamp)
+
+    def add_observation(self, city, provider, values, timestamp=None):
+        """Add all numeric fields of a normalized API answer."""
+        with self.lock:
+            if timestamp is None:
+                timestamp = self.clock()
+            for field in NUMERIC_FIELDS:
+                value = values.get(field)
+                if isinstance(value, (int, float)):
+                    self._add(city, field, provider, value, timestamp)
+
+    def _add(self, city, field, provider, value, timestamp):
+        key = (city, field)
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = RollingWindow(self.window)
+        timestamp = window.add(timestamp, value)
+        self.latest.setdefault(key, {})[provider] = (timestamp, value)
+
+    def summary(self, city, field):
+        """Statistics of one field of one city, None if there is nothing in the window.
+
+        spread is the difference between the highest and the lowest latest value of the APIs,
+        so it shows how much they disagree right now.
+        """
+        now = self.clock()
+        key = (city, field)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                return None
+            window.expire(now)
+            result = window.summary()
+            if result is None:
+                return None
+            latest = [value for timestamp, value in self.latest[key].values() if timestamp > now - self.window]
+            result["spread"] = max(latest) - min(latest) if latest else 0
+            result["providers"] = len(latest)
+            return result
+
+    def city_summary(self, city):
+        """Statistics of every field we know for the city."""
+        summaries = {}
+        for field in NUMERIC_FIELDS:
+            result = self.summary(city, field)
+            if result is not None:
+                summaries[field] = result
+        return summaries
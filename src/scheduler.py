@@ -0,0 +1,184 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+"""Priority classes, the first one is the most important."""
+PRIORITIES = ("interactive", "prefetch", "bulk")
+
+
+class _Task:
+    def __init__(self, priority, fn, args, kwargs):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+
+class _PriorityExecutor:
+    """Looks like a ThreadPoolExecutor, but sends everything to the scheduler with one priority."""
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def submit(self, fn, *args, **kwargs):
+        return self.scheduler.submit(self.priority, fn, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FetchScheduler:
+    """One pool of threads for all the fetching, interactive calls always go first.
+
+    - Queued work is taken by priority, FIFO inside one class.
+    - `reserved` threads are kept for interactive work only, so a user never waits behind bulk jobs.
+    - Every class has a limit of queued tasks, over it submit() raises queue.Full. When the whole
+      queue is full, the newest task of a lower class is cancelled to make room (preemption).
+
+    Use it with aggregate_weather_data(city, data_sources, executor=scheduler.executor("interactive")).
+    """
+
+    def __init__(self, workers=16, reserved=4, max_queued=None, capacity=10000, samples=1000):
+        if not 0 <= reserved < workers:
+            raise ValueError("reserved must be lower than the number of workers")
+        self.workers = workers
+        self.reserved = reserved
+        self.capacity = capacity
+        self.max_queued = {"interactive": capacity, "prefetch": capacity, "bulk": capacity}
+        self.max_queued.update(max_queued or {})
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.counters = {
+            priority: {"submitted": 0, "rejected": 0, "preempted": 0, "completed": 0} for priority in PRIORITIES
+        }
+        self.wait_times = {priority: deque(maxlen=samples) for priority in PRIORITIES}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"fetch-scheduler-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def executor(self, priority):
+        """Executor like object which submits with the given priority."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}")
+        return _PriorityExecutor(self, priority)
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """Queue a call and return its Future."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}")
+        task = _Task(priority, fn, args, kwargs)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The scheduler has been shut down")
+            if len(self.queues[priority]) >= self.max_queued[priority]:
+                self.counters[priority]["rejected"] += 1
+                raise queue.Full(f"Too many queued {priority} tasks")
+            if self._queued() >= self.capacity and not self._preempt(priority):
+                self.counters[priority]["rejected"] += 1
+                raise queue.Full("The scheduler queue is full")
+            self.queues[priority].append(task)
+            self.counters[priority]["submitted"] += 1
+            self.condition.notify()
+        return task.future
+
+    def metrics(self):
+        """Queue depth, running tasks and wait times (in seconds) of each priority class."""
+        with self.condition:
+            result = {}
+            for priority in PRIORITIES:
+                waits = sorted(self.wait_times[priority])
+                result[priority] = dict(
+                    self.counters[priority],
+                    queued=len(self.queues[priority]),
+                    running=self.running[priority],
+                    avg_wait=sum(waits) / len(waits) if waits else 0.0,
+                    p99_wait=waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+                )
+            return result
+
+    def shutdown(self, wait=True):
+        """Stop the workers, the tasks still in the queue are cancelled."""
+        with self.condition:
+            self.closed = True
+            for tasks in self.queues.values():
+                while tasks:
+                    self._cancel(tasks.popleft())
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
+    def _queued(self):
+        return sum(len(tasks) for tasks in self.queues.values())
+
+    @staticmethod
+    def _cancel(task):
+        """Cancel a task which will never run, so as_completed() and wait() learn about it too."""
+        task.future.cancel()
+        task.future.set_running_or_notify_cancel()
+
+    def _preempt(self, priority):
+        """Cancel the newest queued task of the lowest class below priority, False if there is none."""
+        for lower in reversed(PRIORITIES[PRIORITIES.index(priority) + 1:]):
+            if self.queues[lower]:
+                self._cancel(self.queues[lower].pop())
+                self.counters[lower]["preempted"] += 1
+                return True
+        return False
+
+    def _next_task(self):
+        """Highest priority task this worker may run now, the reserved threads only take interactive work."""
+        if self.queues["interactive"]:
+            return self.queues["interactive"].popleft()
+        background = sum(self.running[priority] for priority in PRIORITIES[1:])
+        if background >= self.workers - self.reserved:
+            return None
+        for priority in PRIORITIES[1:]:
+            if self.queues[priority]:
+                return self.queues[priority].popleft()
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                task = self._next_task()
+                while task is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    task = self._next_task()
+                self.running[task.priority] += 1
+                self.wait_times[task.priority].append(time.monotonic() - task.queued_at)
+
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        task.future.set_result(task.fn(*task.args, **task.kwargs))
+                    except BaseException as e:
+                        logging.error(f"Scheduled {task.priority} task failed: {e}")
+                        task.future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.running[task.priority] -= 1
+                    self.counters[task.priority]["completed"] += 1
+                    self.condition.notify_all()
@@ -0,0 +1,174 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+"""Active tracer, None means tracing is off and span() does nothing."""
+_tracer = None
+_disabled = nullcontext()
+
+
+class Span:
+    """One timed piece of work, with the spans that ran inside it."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "start_ms": (self.start - origin) * 1000,
+            "duration_ms": self.duration * 1000,
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+class Tracer:
+    """Collects a tree of spans for every traced call."""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.roots = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        span = Span(name, attributes)
+        with self.lock:
+            (stack[-1].children if stack else self.roots).append(span)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            stack.pop()
+
+    def wrap(self, fn):
+        """Spans started by fn in another thread become children of the current span."""
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+
+        def traced(*args, **kwargs):
+            previous = getattr(self.local, "stack", None)
+            self.local.stack = [parent] if parent is not None else []
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.stack = previous
+        return traced
+
+    def to_json(self):
+        """The span trees as plain dicts."""
+        return [root.to_dict(self.origin) for root in self.roots]
+
+    def to_chrome_trace(self):
+        """The spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = []
+        pid = os.getpid()
+        pending = list(self.roots)
+        while pending:
+            span = pending.pop()
+            events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": (span.start - self.origin) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": pid,
+                "tid": span.thread,
+                "args": span.attributes,
+            })
+            pending.extend(span.children)
+        events.sort(key=lambda event: event["ts"])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path, format="json"):
+        """Write the trace to a file, format is "json" or "chrome"."""
+        data = self.to_chrome_trace() if format == "chrome" else self.to_json()
+        with open(path, "w") as file:
+            json.dump(data, file, default=str)
+
+
+def span(name, **attributes):
+    """Time a block as a child of the current span, it costs just this call when tracing is off."""
+    if _tracer is None:
+        return _disabled
+    return _tracer.span(name, **attributes)
+
+def traced(name):
+    """Decorator, every call of the function becomes a span with its first argument as "target"."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            with _tracer.span(name, target=args[0] if args else None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def wrap(fn):
+    """Use it on functions sent to other threads, so their spans stay in the tree."""
+    if _tracer is None:
+        return fn
+    return _tracer.wrap(fn)
+
+def enable():
+    """Start tracing with a new tracer and return it."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def disable():
+    """Stop tracing and return the tracer with what has been collected."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+@contextmanager
+def trace():
+    """Trace everything inside the block."""
+    tracer = enable()
+    try:
+        yield tracer
+    finally:
+        disable()
+
+@contextmanager
+def profile(path=None, sort="cumulative", limit=30):
+    """Run the block under cProfile, the stats go to path (for snakeviz, pstats...) or to the log."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+            logging.info(f"Profile:\n{output.getvalue()}")